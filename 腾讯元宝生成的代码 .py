@@ -10,12 +10,15 @@ warnings.filterwarnings("ignore", category=DeprecationWarning, module="telnetlib
 3. 保留多线程巡检、日志记录等全部原有功能
 """
 
+import io
 import logging
 import re
 import os
 import time
 import platform
+import select
 import pandas as pd
+import paramiko
 import tkinter as tk
 from tkinter import messagebox, filedialog
 from netmiko import ConnectHandler, NetmikoAuthenticationException, NetmikoTimeoutException
@@ -23,8 +26,26 @@ from netmiko.base_connection import BaseConnection
 from netmiko.ssh_dispatcher import CLASS_MAPPER
 from concurrent.futures import ThreadPoolExecutor, as_completed
 import shutil
-import telnetlib
+try:
+    import telnetlib
+except ImportError:
+    # Python 3.13 起标准库已移除 telnetlib，改用 Netmiko 自带的副本
+    from netmiko._telnetlib import telnetlib
 import threading
+import queue
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+
+# 读取数值型环境变量，取值无效时记录警告并使用默认值，避免启动即崩溃
+def env_number(name, default, convert=int):
+    value = os.environ.get(name)
+    if value is None or not value.strip():
+        return default
+    try:
+        return convert(value)
+    except ValueError:
+        logging.warning(f"环境变量 {name}={value!r} 无效，使用默认值 {default}")
+        return default
 
 # 全局配置（保持不变）
 DEVICE_TYPES = {
@@ -44,27 +65,153 @@ DEFAULT_PORTS = {
     "telnet": 23
 }
 SUPPORTED_DEVICES = set(CLASS_MAPPER.keys())
+
+# 根据品牌和登录协议确定 device_type
+def resolve_device_type(brand, protocol):
+    base_type = DEVICE_TYPES.get(brand, "autodetect")
+    protocol_suffix = PROTOCOL_MAP.get(protocol, "")
+    device_type = f"{base_type}{protocol_suffix}"
+    # 处理迪普设备 Telnet 连接
+    if brand == "迪普" and protocol == "telnet":
+        if "dptech_os_telnet" in SUPPORTED_DEVICES:
+            device_type = "dptech_os_telnet"
+        else:
+            device_type = "custom_dptech_telnet"
+    elif protocol == "telnet":
+        if f"{base_type}_telnet" in SUPPORTED_DEVICES:
+            device_type = f"{base_type}_telnet"
+        else:
+            device_type = "autodetect_telnet"
+    else:
+        if device_type not in SUPPORTED_DEVICES:
+            device_type = "autodetect"
+    return device_type
+
+# (品牌, 协议) -> device_type 对照表，加载设备时直接查表
+DEVICE_TYPE_TABLE = {
+    (brand, protocol): resolve_device_type(brand, protocol)
+    for brand in DEVICE_TYPES
+    for protocol in PROTOCOL_MAP
+}
 RETRY_CONFIG = {
     "max_retries": 5,
-    "retry_interval": 0.5
+    "retry_interval": 0.5,
+    # 重试间隔按指数退避增长的上限（秒）
+    "max_retry_interval": 5,
+    # 单台设备连接重试的总时长上限（秒），超过后不再重试，尽快释放巡检线程
+    "max_retry_time": 60
+}
+# 线程池配置：巡检为网络I/O密集型任务，线程数按设备数量取值并设置上限
+THREAD_POOL_CONFIG = {
+    "max_workers": env_number("INSPECT_MAX_WORKERS", env_number("THREAD_POOL_SIZE", 64)),
+    # 同一设备（按地址和端口区分，如WLC、堆叠）同时允许的会话数，0 表示不限制
+    # 终端服务器、NAT端口映射等同一地址不同端口对应不同设备，按 (地址, 端口) 计数，互不影响
+    "host_max_sessions": env_number("HOST_MAX_SESSIONS", 0),
+    # 同一品牌同时允许的会话数，0 表示不限制
+    "brand_max_sessions": env_number("BRAND_MAX_SESSIONS", 0)
+}
+# 连接池配置：复用已建立的SSH/Telnet会话，省去重复的握手、认证和分页设置
+# 单次巡检中每台设备只连接一次，连接池只对短时间内重复巡检有收益；空闲会话会占用设备vty线路，默认关闭
+CONNECTION_POOL_CONFIG = {
+    "enabled": os.environ.get("CONNECTION_POOL_ENABLED", "0") == "1",
+    "max_size": env_number("CONNECTION_POOL_MAX_SIZE", 64),
+    "idle_timeout": env_number("CONNECTION_POOL_IDLE_TIMEOUT", 120, float),
+    "max_age": env_number("CONNECTION_POOL_MAX_AGE", 1800, float)
+}
+# Netmiko 读写调优：fast_cli 去掉可靠性优先的固定延时
+NETMIKO_CONFIG = {
+    "fast_cli": True,
+    "global_delay_factor": env_number("NETMIKO_DELAY", 0.1, float),
+    # 已知在 fast_cli 或流水线下发时输出截断、命令丢失的设备类型（前缀匹配），保持默认延时且不使用流水线
+    # 注意：DEVICE_TYPES 中现有品牌都不会产生这些类型，此项只对后续新增的品牌生效
+    "slow_device_types": ("arista", "mikrotik"),
+    # 为 1 时一次写入全部命令后统一读取（流水线），对现有全部品牌生效，遇到不支持预输入的设备请关闭
+    "pipeline_commands": os.environ.get("PIPELINE_COMMANDS", "0") == "1",
+    "pipeline_read_timeout": 60,
+    # 每台SSH设备并发执行命令的会话数，0 或 1 表示不启用；每个会话是独立的SSH连接，会额外占用设备vty线路
+    # 不在同一连接上开多个 exec 通道：思科IOS等设备会拒绝额外通道，或在 exec 结束后断开整个连接
+    "session_workers": env_number("SSH_SESSION_WORKERS", 0)
+}
+# Telnet巡检配置：batch_commands 为 1 时一次写入全部命令后统一读取，个别设备不支持预输入时设为 0
+TELNET_CONFIG = {
+    "batch_commands": os.environ.get("BATCH_COMMANDS", "1") == "1",
+    "read_timeout": 30,
+    # 只在缓冲区末尾这么多字节内查找提示符，避免大输出反复全量扫描
+    "prompt_scan_bytes": 512
+}
+# SSH窗口配置：单位字节，0 表示使用 paramiko 默认值（64 * 2**15，即 2 MiB）
+# 参考取值：常规巡检保持默认；display current-configuration、show tech-support 等大输出命令可设为 8388608（8 MiB）
+# 部分老旧设备在大窗口下会话不稳定，出现卡顿时恢复默认值
+SSH_WINDOW_CONFIG = {
+    "window_size": env_number("NETMIKO_WINDOW_SIZE", 0),
+    "max_packet_size": env_number("NETMIKO_MAX_PACKET_SIZE", 2 ** 15)
 }
 
 # 自定义迪普设备Telnet连接类（新增禁用分页命令）
 class DPTechTelnet(BaseConnection):
+    _PROMPT_SCRUB = re.compile(r'[\r\n]+')
+    _PAGING_OFF = b'terminal line 0\r\n'
+
     def session_preparation(self):
         self._test_channel_read()
         self.set_base_prompt()
         # 发送禁用分页命令（支持terminal line 0）
-        self.write_channel(b'terminal line 0\r\n')
-        time.sleep(0.5)
-        self._test_channel_read()  # 清除命令执行后的输出
+        self.write_channel(self._PAGING_OFF)
+        self.read_until_prompt()  # 读到提示符即清除命令执行后的输出，无需固定等待
 
     def set_base_prompt(self):
         prompt = super().set_base_prompt()
-        return re.sub(r'\n+|\r+', '', prompt).strip()
+        return self._PROMPT_SCRUB.sub('', prompt).strip()
 
 CLASS_MAPPER["dptech_os_telnet"] = DPTechTelnet
 
+# 命令输出中的分页提示和控制符，一次替换全部清除
+OUTPUT_NOISE_RE = re.compile(r'--More\(CTRL\+C break\)--\r?\n?|\x08|\x1b\[.*?m')
+# Telnet原始输出（bytes）使用：分页提示按固定字节串处理，控制符单独匹配
+MORE_PROMPT = b'--More(CTRL+C break)--'
+CONTROL_CHARS_RE = re.compile(rb'\x08|\x1b\[.*?m')
+
+# 扩大SSH窗口，减少大输出命令读取时的 WINDOW_ADJUST 往返
+# paramiko.Transport 的默认窗口在定义时已绑定，修改 paramiko.common 无效，因此替换 SSHClient 使用的 Transport
+class WideWindowTransport(paramiko.Transport):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.default_window_size = SSH_WINDOW_CONFIG["window_size"]
+        self.default_max_packet_size = SSH_WINDOW_CONFIG["max_packet_size"]
+
+def apply_ssh_window_size():
+    if SSH_WINDOW_CONFIG["window_size"] > 0 and paramiko.client.Transport is not WideWindowTransport:
+        paramiko.client.Transport = WideWindowTransport
+
+# 会话并发限制（按设备地址和品牌分别计数）
+_session_semaphores = {}
+_session_semaphores_lock = threading.Lock()
+
+def get_session_semaphore(key, limit):
+    if limit <= 0:
+        return None
+    with _session_semaphores_lock:
+        if key not in _session_semaphores:
+            _session_semaphores[key] = threading.BoundedSemaphore(limit)
+        return _session_semaphores[key]
+
+@contextmanager
+def session_slot(device):
+    semaphores = [
+        get_session_semaphore(("host", device["host"], device["port"]), THREAD_POOL_CONFIG["host_max_sessions"]),
+        get_session_semaphore(("brand", device.get("brand")), THREAD_POOL_CONFIG["brand_max_sessions"])
+    ]
+    acquired = []
+    try:
+        for semaphore in semaphores:
+            if semaphore:
+                semaphore.acquire()
+                acquired.append(semaphore)
+        yield
+    finally:
+        for semaphore in reversed(acquired):
+            semaphore.release()
+
 # 配置日志
 def setup_logging():
     logging.basicConfig(
@@ -80,9 +227,13 @@ def setup_logging():
 def clean_old_files(result_dir, keep_files=10):
     if not os.path.exists(result_dir):
         return
+    dirname = result_dir
     try:
-        dirs = sorted(os.listdir(result_dir), key=lambda x: os.path.getmtime(os.path.join(result_dir, x)), reverse=True)
-        for dirname in dirs[keep_files:]:
+        # 每个条目只取一次修改时间，排序时不再重复调用 getmtime
+        with os.scandir(result_dir) as it:
+            entries = [(entry.stat().st_mtime, entry.name) for entry in it]
+        entries.sort(reverse=True)
+        for _, dirname in entries[keep_files:]:
             shutil.rmtree(os.path.join(result_dir, dirname))
     except Exception as e:
         logging.warning(f"清理文件失败: {dirname} - {str(e)}")
@@ -108,6 +259,10 @@ def generate_excel_template():
     except Exception as e:
         logging.error(f"生成Excel模板失败: {str(e)}")
 
+# 按列取出工作表数据（缺失的可选列使用默认值），避免逐行构造 Series
+def column_values(df, column, default=""):
+    return df[column].tolist() if column in df.columns else [default] * len(df)
+
 # 读取巡检命令选项卡的数据
 def load_inspection_commands(excel_path="devices_info.xlsx"):
     try:
@@ -116,9 +271,8 @@ def load_inspection_commands(excel_path="devices_info.xlsx"):
             return {}
         df = pd.read_excel(excel_path, sheet_name="巡检命令").fillna("")
         command_map = {}
-        for idx, row in df.iterrows():
-            brand = row.get("设备品牌")
-            commands = parse_commands(row.get("巡检命令", ""))
+        for idx, brand, raw_commands in zip(df.index, column_values(df, "设备品牌"), column_values(df, "巡检命令")):
+            commands = parse_commands(raw_commands)
             if not brand:
                 logging.warning(f"第{idx + 2}行 '设备品牌' 字段为空，请检查 '巡检命令' 工作表。")
             if not commands:
@@ -154,55 +308,53 @@ def load_devices(excel_path="devices_info.xlsx"):
         command_map = load_inspection_commands(excel_path)
         if '是否加载批量巡检命令' not in df.columns:
             logging.warning("未找到 '是否加载批量巡检命令' 列，将不加载批量巡检命令。")
-        for idx, row in df.iterrows():
-            missing = [f for f in ["IP地址", "设备品牌", "密码"] if not row[f]]
+        rows = zip(
+            df.index,
+            df["IP地址"].tolist(),
+            df["设备品牌"].tolist(),
+            df["设备品牌"].isin(valid_brands).tolist(),
+            df["密码"].tolist(),
+            df["用户名"].tolist(),
+            df["特权密码"].tolist(),
+            df["端口"].tolist(),
+            df["超时时间"].tolist(),
+            column_values(df, "登录协议", "ssh"),
+            column_values(df, "是否加载批量巡检命令", "否"),
+            column_values(df, "特殊命令")
+        )
+        for idx, ip, brand, brand_valid, password, username, secret, raw_port, raw_timeout, raw_protocol, batch_flag, raw_special in rows:
+            missing = [f for f, value in (("IP地址", ip), ("设备品牌", brand), ("密码", password)) if not value]
             if missing:
                 logging.warning(f"第{idx + 2}行缺失字段: {', '.join(missing)}")
                 continue
-            if row["设备品牌"] not in valid_brands:
-                logging.warning(f"第{idx + 2}行无效品牌: {row['设备品牌']}")
+            if not brand_valid:
+                logging.warning(f"第{idx + 2}行无效品牌: {brand}")
                 continue
-            protocol = str(row.get("登录协议", "ssh")).lower()
+            protocol = str(raw_protocol).lower()
             if protocol not in ["ssh", "telnet"]:
                 logging.warning(f"第{idx + 2}行无效协议: {protocol}，使用SSH")
                 protocol = "ssh"
             try:
-                port = int(row["端口"]) if row["端口"] else DEFAULT_PORTS[protocol]
+                port = int(raw_port) if raw_port else DEFAULT_PORTS[protocol]
             except ValueError:
                 port = DEFAULT_PORTS[protocol]
-                logging.warning(f"第{idx + 2}行无效端口: {row['端口']}，使用{port}")
+                logging.warning(f"第{idx + 2}行无效端口: {raw_port}，使用{port}")
             try:
-                timeout = int(row["超时时间"]) if row["超时时间"] else 30
+                timeout = int(raw_timeout) if raw_timeout else 30
             except ValueError:
                 timeout = 30
                 logging.warning(f"第{idx + 2}行超时时间值无效，使用默认超时时间: 30")
-            load_batch_commands = row.get("是否加载批量巡检命令", "否").strip().lower() == "是"
-            brand_commands = command_map.get(row["设备品牌"], []) if load_batch_commands else []
-            special_commands = parse_commands(row.get("特殊命令", ""))
-            brand = row["设备品牌"]
-            logging.info(f"设备 {row['IP地址']} 的品牌识别为: {brand}")
-            base_type = DEVICE_TYPES.get(brand, "autodetect")
-            protocol_suffix = PROTOCOL_MAP.get(protocol, "")
-            device_type = f"{base_type}{protocol_suffix}"
-            # 处理迪普设备 Telnet 连接
-            if brand == "迪普" and protocol == "telnet":
-                if "dptech_os_telnet" in SUPPORTED_DEVICES:
-                    device_type = "dptech_os_telnet"
-                else:
-                    device_type = "custom_dptech_telnet"
-            elif protocol == "telnet":
-                if f"{base_type}_telnet" in SUPPORTED_DEVICES:
-                    device_type = f"{base_type}_telnet"
-                else:
-                    device_type = "autodetect_telnet"
-            else:
-                if device_type not in SUPPORTED_DEVICES:
-                    device_type = "autodetect"
+            load_batch_commands = str(batch_flag).strip().lower() == "是"
+            brand_commands = command_map.get(brand, []) if load_batch_commands else []
+            special_commands = parse_commands(raw_special)
+            logging.info(f"设备 {ip} 的品牌识别为: {brand}")
+            device_type = DEVICE_TYPE_TABLE.get((brand, protocol), "autodetect")
             device = {
-                "host": row["IP地址"],
-                "username": row["用户名"] or None,
-                "password": row["密码"],
-                "secret": row["特权密码"] or None,
+                "host": ip,
+                "brand": brand,
+                "username": username or None,
+                "password": password,
+                "secret": secret or None,
                 "port": port,
                 "device_type": device_type,
                 "login_protocol": protocol,
@@ -225,6 +377,7 @@ def load_devices(excel_path="devices_info.xlsx"):
 # 设备连接模块
 def connect_device(device):
     retries = 0
+    deadline = time.monotonic() + RETRY_CONFIG["max_retry_time"]
     while retries < RETRY_CONFIG["max_retries"]:
         try:
             if device["device_type"] == "custom_dptech_telnet":
@@ -263,12 +416,19 @@ def connect_device(device):
                     "host": device["host"],
                     "port": device["port"],
                     "password": device["password"],
-                    "timeout": device["timeout"]
+                    "timeout": device["timeout"],
+                    "auto_connect": True
                 }
+                if NETMIKO_CONFIG["fast_cli"] and not device["device_type"].startswith(NETMIKO_CONFIG["slow_device_types"]):
+                    params["fast_cli"] = True
+                    params["global_delay_factor"] = NETMIKO_CONFIG["global_delay_factor"]
+                else:
+                    params["fast_cli"] = False
                 if device["username"]:
                     params["username"] = device["username"]
                 if device["secret"]:
                     params["secret"] = device["secret"]
+                apply_ssh_window_size()
                 # 调试输出
                 logging.info(f"尝试连接设备 {device['host']}，使用 device_type: {device['device_type']}")
                 conn = ConnectHandler(**params)
@@ -287,93 +447,456 @@ def connect_device(device):
                             conn.enable(password=device["secret"])
                 return conn
         except NetmikoAuthenticationException as e:
-            logging.error(f"{device['host']} 认证失败: {str(e)}，第 {retries + 1} 次尝试")
+            # 认证失败重试无意义，还可能触发设备账号锁定，直接放弃
+            logging.error(f"{device['host']} 认证失败: {str(e)}，不再重试")
+            retries += 1
+            break
         except NetmikoTimeoutException:
             logging.error(f"{device['host']} 连接超时，第 {retries + 1} 次尝试")
         except Exception as e:
             logging.error(f"{device['host']} 连接失败: {str(e)}，第 {retries + 1} 次尝试")
         retries += 1
-        time.sleep(RETRY_CONFIG["retry_interval"])
-    logging.error(f"{device['host']} 经过 {RETRY_CONFIG['max_retries']} 次尝试后仍无法连接")
+        if retries >= RETRY_CONFIG["max_retries"]:
+            break
+        retry_interval = min(RETRY_CONFIG["retry_interval"] * 2 ** (retries - 1), RETRY_CONFIG["max_retry_interval"])
+        if time.monotonic() + retry_interval > deadline:
+            logging.error(f"{device['host']} 连接重试已超过 {RETRY_CONFIG['max_retry_time']} 秒，停止重试")
+            break
+        time.sleep(retry_interval)
+    logging.error(f"{device['host']} 经过 {retries} 次尝试后仍无法连接")
     return None
 
-# 巡检执行模块（关键优化：分页提示过滤）
-def execute_inspection(device, result_dir):
-    host = device["host"]
-    timestamp = time.strftime("%Y%m%d-%H%M%S")
-    inspection_time = time.strftime("%Y-%m-%d %H:%M:%S")
-    conn = connect_device(device)
-    if not conn:
-        error_path = os.path.join(result_dir, "errors")
+# 关闭连接
+def close_connection(conn):
+    try:
+        if isinstance(conn, telnetlib.Telnet):
+            conn.close()
+        else:
+            conn.disconnect()
+    except Exception as e:
+        logging.debug(f"关闭连接失败: {str(e)}")
+
+# 连接池：按 (host, port, username, device_type) 复用会话，空闲超时或超过最大存活时间后淘汰
+class ConnectionPool:
+    def __init__(self, max_size=64, idle_timeout=120, max_age=1800, enabled=True):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_age = max_age
+        self.enabled = enabled
+        self._lock = threading.RLock()
+        self._idle = OrderedDict()
+        self._reaper = None
+
+    @staticmethod
+    def make_key(device):
+        return (device["host"], device["port"], device["username"], device["device_type"])
+
+    def get(self, device):
+        key = self.make_key(device)
+        if self.enabled:
+            with self._lock:
+                expired = self._pop_expired()
+                entry = self._idle.pop(key, None)
+            for stale in expired:
+                close_connection(stale["conn"])
+            if entry:
+                if self._is_alive(entry["conn"]):
+                    logging.debug(f"{device['host']} 复用连接池中的会话")
+                    entry["reused"] = True
+                    return entry
+                # 复用的会话已失效，淘汰后重新连接一次
+                logging.info(f"{device['host']} 连接池中的会话已失效，重新建立连接")
+                close_connection(entry["conn"])
+        conn = connect_device(device)
+        if not conn:
+            return None
+        now = time.monotonic()
+        return {"key": key, "conn": conn, "created": now, "last_used": now, "sysname": None, "reused": False}
+
+    def release(self, entry):
+        if not self.enabled:
+            close_connection(entry["conn"])
+            return
+        entry["last_used"] = time.monotonic()
+        with self._lock:
+            if entry["key"] in self._idle:
+                # 同一设备已有空闲会话，多余的直接关闭
+                expired = [entry]
+            else:
+                self._idle[entry["key"]] = entry
+                expired = self._pop_expired()
+                while len(self._idle) > self.max_size:
+                    expired.append(self._idle.popitem(last=False)[1])
+                self._start_reaper()
+        for stale in expired:
+            close_connection(stale["conn"])
+
+    def evict(self, entry):
+        with self._lock:
+            if self._idle.get(entry["key"]) is entry:
+                del self._idle[entry["key"]]
+        close_connection(entry["conn"])
+
+    def close_all(self):
+        with self._lock:
+            entries = list(self._idle.values())
+            self._idle.clear()
+        for entry in entries:
+            close_connection(entry["conn"])
+
+    @contextmanager
+    def acquire(self, device):
+        entry = self.get(device)
+        if not entry:
+            yield None
+            return
         try:
-            os.makedirs(error_path, exist_ok=True)
-            error_filename = f"{host}_{timestamp}.error.log"
-            with open(os.path.join(error_path, error_filename), "w", encoding="utf-8") as f:
-                f.write(f"设备连接失败，无法获取设备名称。")
-            logging.error(f"设备 {host} 连接失败，跳过巡检")
-        except Exception as e:
-            logging.error(f"创建错误日志文件失败: {str(e)}")
-        return False
+            yield entry
+        except BaseException:
+            self.evict(entry)
+            raise
+        else:
+            self.release(entry)
 
+    # 后台定期关闭超时的空闲会话，连接池清空后线程退出
+    def _start_reaper(self):
+        if self._reaper is None and self._idle:
+            self._reaper = threading.Thread(target=self._reap, name="connection-pool-reaper", daemon=True)
+            self._reaper.start()
+
+    def _reap(self):
+        interval = max(1.0, min(self.idle_timeout, self.max_age) / 4)
+        while True:
+            time.sleep(interval)
+            with self._lock:
+                expired = self._pop_expired()
+                finished = not self._idle
+                if finished:
+                    self._reaper = None
+            for stale in expired:
+                close_connection(stale["conn"])
+            if finished:
+                return
+
+    def _pop_expired(self):
+        now = time.monotonic()
+        expired = []
+        for key, entry in list(self._idle.items()):
+            if now - entry["last_used"] > self.idle_timeout or now - entry["created"] > self.max_age:
+                expired.append(self._idle.pop(key))
+        return expired
+
+    @staticmethod
+    def _is_alive(conn):
+        try:
+            if isinstance(conn, telnetlib.Telnet):
+                conn.read_very_eager()  # 连接已关闭时抛出 EOFError
+                return conn.get_socket() is not None
+            conn.find_prompt()
+            return True
+        except Exception:
+            return False
+
+CONNECTION_POOL = ConnectionPool(**CONNECTION_POOL_CONFIG)
+
+# 设备提示符结尾匹配（每台设备编译一次）；Telnet路径传入原始字节，直接匹配未解码的输出
+def build_prompt_tail_re(device_name):
+    if isinstance(device_name, bytes):
+        return re.compile(rb'<?\s*' + re.escape(device_name) + rb'[>#]\s*$')
+    return re.compile(rf'<?\s*{re.escape(device_name)}[>#]\s*$')
+
+# 设备名称解码：提示符中可能是 UTF-8 或 GBK 编码的中文主机名
+def decode_device_name(raw_name):
     try:
-        command_outputs = []
-        if isinstance(conn, telnetlib.Telnet):
-            tn = conn
-            tn.write(b'\r\n')
-            time.sleep(0.5)
-            output = tn.read_until(b'>', timeout=10).decode('ascii', errors='replace')
-            device_name = re.search(r'<\s*(\S+)\s*>', output).group(1) or "未知设备"
-
-            for command in device["commands"]:
-                tn.write((command + "\r\n").encode("ascii"))
-                time.sleep(0.3)
-                output_buffer = []
-                # 禁用分页后无需循环翻页，直接读取完整输出
-                current_output = tn.read_until(b'>', timeout=30)  # 延长单次读取超时
-                output_buffer.append(current_output)
-                command_output = b''.join(output_buffer).decode('ascii', errors='replace')
-                # 增强清理规则：去除分页提示及多余空格
-                command_output = re.sub(r'--More\(CTRL\+C break\)--.*?\r?\n?', '', command_output, flags=re.DOTALL)
-                command_output = re.sub(r'\x08|\x1b\[.*?m', '', command_output)  # 保留原有控制符清理
-                command_output = re.sub(rf'^{re.escape(command)}\s*\r?\n', '', command_output)
-                command_output = re.sub(rf'{re.escape(device_name)}[>#]\s*$', '', command_output).strip()
-                command_outputs.append((command, command_output))
+        return raw_name.decode('utf-8')
+    except UnicodeDecodeError:
+        return raw_name.decode('gbk', errors='replace')
+
+# 去除命令回显：输出以命令本身开头时按偏移量截掉回显行
+def strip_command_echo(output, command):
+    if not output.startswith(command):
+        return output
+    line_end = output.find('\n', len(command))
+    if line_end == -1 or output[len(command):line_end].strip():
+        return output
+    return output[line_end + 1:]
+
+# 去除分页提示及其后紧跟的换行；已禁用分页时输出中通常没有分页提示，直接返回
+def strip_more_prompts(data):
+    if b'--More' not in data:
+        return data
+    parts = data.split(MORE_PROMPT)
+    for i in range(1, len(parts)):
+        part = parts[i]
+        if part.startswith(b'\r'):
+            part = part[1:]
+        if part.startswith(b'\n'):
+            part = part[1:]
+        parts[i] = part
+    return b''.join(parts)
+
+# 清理Telnet命令输出（prompt_tail 为字节正则，在解码前去除提示符，非ASCII主机名也能匹配）
+def clean_telnet_output(raw_output, command, prompt_tail):
+    # 增强清理规则：去除分页提示、控制符及多余空格
+    raw_output = strip_more_prompts(raw_output)
+    if b'\x08' in raw_output or b'\x1b' in raw_output:
+        raw_output = CONTROL_CHARS_RE.sub(b'', raw_output)
+    raw_output = prompt_tail.sub(b'', raw_output, count=1)
+    command_output = raw_output.decode('ascii', errors='replace')
+    return strip_command_echo(command_output, command).strip()
+
+# 读取Telnet输出直到出现设备提示符，只在缓冲区末尾查找提示符；返回 (输出, 是否读到提示符)
+def telnet_read_until_prompt(tn, prompt_re, timeout):
+    sock = tn.get_socket()
+    scan_bytes = TELNET_CONFIG["prompt_scan_bytes"]
+    buffer = io.BytesIO()
+    tail = b''
+    deadline = time.monotonic() + timeout
+    while not prompt_re.search(tail) and time.monotonic() < deadline:
+        data = tn.read_very_eager()
+        if data:
+            buffer.write(data)
+            tail = (tail + data)[-scan_bytes:]
+            continue
+        select.select([sock], [], [], 0.05)
+    return buffer.getvalue(), bool(prompt_re.search(tail))
+
+# 持续读取直到收齐指定数量的提示符或空闲超时，返回收到的提示符数量
+# 每条命令执行完都会回显一次提示符；只扫描新数据及其前面一小段，提示符跨两次读取时也能匹配到
+def read_until_prompt_count(read, wait, prompt_re, count, buffer, timeout):
+    tail = buffer.getvalue()[:0]
+    prompts_seen = 0
+    last_prompt_end = 0
+    deadline = time.monotonic() + timeout
+    while prompts_seen < count and time.monotonic() < deadline:
+        data = read()
+        if not data:
+            wait()
+            continue
+        window_start = buffer.tell() - len(tail)
+        buffer.write(data)
+        window = tail + data
+        for match in prompt_re.finditer(window):
+            if window_start + match.start() >= last_prompt_end:
+                prompts_seen += 1
+                last_prompt_end = window_start + match.end()
+        tail = window[-TELNET_CONFIG["prompt_scan_bytes"]:]
+        deadline = time.monotonic() + timeout
+    return prompts_seen
+
+# Telnet批量下发命令：一次写入全部命令，再按设备提示符切分输出
+# prompt_name 为提示符中的原始主机名字节，不经过解码，避免非ASCII主机名无法匹配
+def telnet_batch_commands(tn, commands, prompt_name, device_name):
+    prompt_re = re.compile(rb'<\s*' + re.escape(prompt_name) + rb'\s*>')
+    prompt_tail = build_prompt_tail_re(prompt_name)
+    packet = ("\r\n".join(commands) + "\r\n").encode("ascii")
+    tn.write(packet)
+    sock = tn.get_socket()
+    buffer = io.BytesIO()
+    prompts_seen = read_until_prompt_count(
+        tn.read_very_eager, lambda: select.select([sock], [], [], 1.0),
+        prompt_re, len(commands), buffer, TELNET_CONFIG["read_timeout"]
+    )
+    if prompts_seen < len(commands):
+        logging.warning(f"设备 {device_name} 批量命令输出不完整：收到 {prompts_seen}/{len(commands)} 个提示符")
+    segments = prompt_re.split(buffer.getvalue())
+    command_outputs = []
+    for i, command in enumerate(commands):
+        segment = segments[i] if i < len(segments) else b""
+        output = clean_telnet_output(segment, command, prompt_tail)
+        if i >= prompts_seen:
+            # 未读到该命令结束的提示符，输出可能被截断
+            output = f"[输出不完整：{TELNET_CONFIG['read_timeout']} 秒内未读到设备提示符]\n{output}"
+        command_outputs.append((command, output))
+    return command_outputs
+
+# Telnet逐条下发命令，每读完一条命令的输出即返回；prompt_name 为提示符中的原始主机名字节
+def telnet_iter_commands(tn, commands, prompt_name, device_name):
+    prompt_re = re.compile(rb"\r?\n\s*<\s*" + re.escape(prompt_name) + rb"\s*>\s*$")
+    prompt_tail = build_prompt_tail_re(prompt_name)
+    for command in commands:
+        tn.write((command + "\r\n").encode("ascii"))
+        # 禁用分页后无需循环翻页，直接读取完整输出
+        current_output, complete = telnet_read_until_prompt(tn, prompt_re, TELNET_CONFIG["read_timeout"])
+        output = clean_telnet_output(current_output, command, prompt_tail)
+        if not complete:
+            logging.warning(f"设备 {device_name} 命令 {command} 在 {TELNET_CONFIG['read_timeout']} 秒内未读到提示符，输出可能不完整")
+            output = f"[输出不完整：{TELNET_CONFIG['read_timeout']} 秒内未读到设备提示符]\n{output}"
+        yield command, output
+
+# Netmiko逐条下发命令，每读完一条命令的输出即返回
+def netmiko_iter_commands(conn, commands, expect_string, prompt_tail, read_timeout):
+    for cmd in commands:
+        output = conn.send_command(cmd, read_timeout=read_timeout, expect_string=expect_string)
+        output = strip_command_echo(output, cmd)
+        yield cmd, prompt_tail.sub('', output, count=1).strip()
+
+# SSH多会话并发执行命令：额外建立 workers-1 个独立连接，与当前连接一起分担命令，按输入顺序返回输出
+# 同时在途的命令数不超过会话数，已完成的输出按顺序交给调用方写入报告，不会全部堆积在内存中
+def parallel_session_commands(conn, device, commands, expect_string, prompt_tail, workers):
+    sessions = queue.Queue()
+    sessions.put(conn)
+    extra_sessions = []
+    for _ in range(workers - 1):
+        extra_conn = connect_device(device)
+        if not extra_conn:
+            logging.warning(f"{device['host']} 无法建立额外会话，使用 {sessions.qsize()} 个会话并发执行")
+            break
+        extra_sessions.append(extra_conn)
+        sessions.put(extra_conn)
+
+    def run(cmd):
+        session = sessions.get()
+        try:
+            return next(netmiko_iter_commands(session, [cmd], expect_string, prompt_tail, device["timeout"]))
+        finally:
+            sessions.put(session)
+
+    session_count = sessions.qsize()
+    try:
+        with ThreadPoolExecutor(max_workers=session_count) as executor:
+            pending = deque()
+            for cmd in commands:
+                pending.append(executor.submit(run, cmd))
+                if len(pending) >= session_count:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+    finally:
+        for extra_conn in extra_sessions:
+            close_connection(extra_conn)
+
+# Netmiko流水线下发命令：一次写入全部命令，再按完整提示符切分输出
+def netmiko_pipeline_commands(conn, commands, prompt, prompt_tail):
+    prompt_re = re.compile(re.escape(prompt))
+    conn.write_channel(conn.RETURN.join(commands) + conn.RETURN)
+    buffer = io.StringIO()
+    prompts_seen = read_until_prompt_count(
+        conn.read_channel, lambda: time.sleep(0.05),
+        prompt_re, len(commands), buffer, NETMIKO_CONFIG["pipeline_read_timeout"]
+    )
+    if prompts_seen < len(commands):
+        logging.warning(f"设备 {prompt} 流水线命令输出不完整：收到 {prompts_seen}/{len(commands)} 个提示符")
+    segments = prompt_re.split(buffer.getvalue())
+    command_outputs = []
+    for i, cmd in enumerate(commands):
+        output = segments[i] if i < len(segments) else ""
+        # read_channel 返回原始输出，按 send_command 的方式统一换行并去除控制符，保证报告与逐条下发一致
+        output = conn.normalize_linefeeds(conn.strip_ansi_escape_codes(output))
+        output = OUTPUT_NOISE_RE.sub('', output)
+        output = strip_command_echo(output.lstrip('\n'), cmd)
+        command_outputs.append((cmd, prompt_tail.sub('', output, count=1).strip()))
+    return command_outputs
+
+# 使用已建立的连接执行巡检并写入报告，返回报告文件路径
+def run_inspection(entry, device, result_dir, timestamp, inspection_time):
+    host = device["host"]
+    conn = entry["conn"]
+    if isinstance(conn, telnetlib.Telnet):
+        tn = conn
+        tn.write(b'\r\n')
+        output = tn.read_until(b'>', timeout=10)
+        # 提示符按原始字节提取，中文主机名也能原样用于后续提示符匹配
+        prompt_name = re.search(rb'<\s*(\S+)\s*>', output).group(1)
+        device_name = decode_device_name(prompt_name) or "未知设备"
+
+        if TELNET_CONFIG["batch_commands"] and device["commands"]:
+            command_outputs = telnet_batch_commands(tn, device["commands"], prompt_name, device_name)
         else:
-            # 非迪普设备保持原有逻辑
-            prompt = conn.find_prompt()
-            device_name = re.search(r'^(\S+)[>#]', prompt).group(1) or "未知设备"
-            if "hp_comware" in device["device_type"]:
+            command_outputs = telnet_iter_commands(tn, device["commands"], prompt_name, device_name)
+    else:
+        # 非迪普设备保持原有逻辑
+        prompt = conn.find_prompt()
+        device_name = re.search(r'^(\S+)[>#]', prompt).group(1) or "未知设备"
+        if "hp_comware" in device["device_type"]:
+            # 复用连接时直接使用首次查询到的 sysname，省去一次命令往返
+            if entry["sysname"]:
+                device_name = entry["sysname"]
+            else:
                 try:
                     output = conn.send_command("display current-configuration | include sysname", read_timeout=10)
                     match = re.search(r"sysname (\S+)", output)
                     if match:
                         device_name = match.group(1)
+                        entry["sysname"] = device_name
                 except Exception:
                     pass
-            for cmd in device["commands"]:
-                output = conn.send_command(cmd)
-                output = re.sub(rf'^{re.escape(cmd)}\s*\r?\n', '', output)
-                output = re.sub(rf'{re.escape(device_name)}[>#]\s*$', '', output).strip()
-                command_outputs.append((cmd, output))
-
-        # 保存巡检结果
-        safe_device_name = re.sub(r'[\\/*?:"<>|]', '_', device_name)
-        device_dir = os.path.join(result_dir, f"{host}__{safe_device_name}")
-        os.makedirs(device_dir, exist_ok=True)
-        report_filename = os.path.join(device_dir, f"{timestamp}.txt")
-        with open(report_filename, "w", encoding="utf-8") as f:
-            f.write(f"=== 设备巡检报告 ===\n")
-            f.write(f"设备 IP: {host}\n")
-            f.write(f"设备名称: {device_name}\n")
-            f.write(f"巡检时间: {inspection_time}\n")
-            f.write(f"登录协议: {device['login_protocol']}\n")
-            f.write(f"=== 巡检命令输出 ===\n\n")
-            separator = '#' * 40 + '\n'
+        # 匹配到完整提示符即结束读取，不再等待默认的读取超时
+        expect_string = re.escape(prompt)
+        prompt_tail = build_prompt_tail_re(device_name)
+        pipeline = (
+            NETMIKO_CONFIG["pipeline_commands"] and device["commands"]
+            and not device["device_type"].startswith(NETMIKO_CONFIG["slow_device_types"])
+        )
+        parallel = (
+            NETMIKO_CONFIG["session_workers"] > 1 and len(device["commands"]) > 1
+            and device["login_protocol"] == "ssh"
+        )
+        if parallel:
+            workers = min(NETMIKO_CONFIG["session_workers"], len(device["commands"]))
+            command_outputs = parallel_session_commands(conn, device, device["commands"], expect_string, prompt_tail, workers)
+        elif pipeline:
+            command_outputs = netmiko_pipeline_commands(conn, device["commands"], prompt, prompt_tail)
+        else:
+            command_outputs = netmiko_iter_commands(conn, device["commands"], expect_string, prompt_tail, device["timeout"])
+
+    # 保存巡检结果：先写报告头，再按命令逐条写入输出
+    # 逐条下发路径（Telnet逐条、Netmiko逐条）内存中只保留一条命令的输出，多会话并发路径最多保留会话数条；
+    # Telnet批量（迪普Telnet默认）和Netmiko流水线路径会先读完全部输出再逐条写入，不受此限制
+    safe_device_name = re.sub(r'[\\/*?:"<>|]', '_', device_name)
+    device_dir = os.path.join(result_dir, f"{host}__{safe_device_name}")
+    os.makedirs(device_dir, exist_ok=True)
+    report_filename = os.path.join(device_dir, f"{timestamp}.txt")
+    separator = '#' * 40 + '\n'
+    with open(report_filename, "w", encoding="utf-8") as f:
+        f.write("".join((
+            "=== 设备巡检报告 ===\n",
+            f"设备 IP: {host}\n",
+            f"设备名称: {device_name}\n",
+            f"巡检时间: {inspection_time}\n",
+            f"登录协议: {device['login_protocol']}\n",
+            "=== 巡检命令输出 ===\n\n"
+        )))
+        try:
             for command, output in command_outputs:
-                f.write(separator)
-                f.write(f"--- 命令: {command} ---\n")
-                f.write(f"{output}\n\n")
-            f.write(separator)
+                f.write("".join((separator, f"--- 命令: {command} ---\n", output, "\n\n")))
+                del output
+        except Exception as e:
+            # 已写入的部分保留，在报告末尾明确标记中断，避免被当作完整报告
+            f.write("".join((separator, f"=== 巡检中断: {str(e)} ===\n")))
+            raise
+        f.write(separator)
+    return report_filename
+
+# 巡检执行模块（关键优化：分页提示过滤）
+def execute_inspection(device, result_dir, timestamp=None):
+    host = device["host"]
+    timestamp = timestamp or time.strftime("%Y%m%d-%H%M%S")
+    inspection_time = time.strftime("%Y-%m-%d %H:%M:%S")
+    try:
+        for attempt in range(2):
+            reused = False
+            try:
+                with CONNECTION_POOL.acquire(device) as entry:
+                    if not entry:
+                        error_path = os.path.join(result_dir, "errors")
+                        try:
+                            os.makedirs(error_path, exist_ok=True)
+                            error_filename = f"{host}_{timestamp}.error.log"
+                            with open(os.path.join(error_path, error_filename), "w", encoding="utf-8") as f:
+                                f.write(f"设备连接失败，无法获取设备名称。")
+                            logging.error(f"设备 {host} 连接失败，跳过巡检")
+                        except Exception as e:
+                            logging.error(f"创建错误日志文件失败: {str(e)}")
+                        return False
+                    reused = entry["reused"]
+                    report_filename = run_inspection(entry, device, result_dir, timestamp, inspection_time)
+                break
+            except (NetmikoTimeoutException, OSError, EOFError) as e:
+                # 复用的会话在巡检过程中断开：连接已被淘汰，重新建立连接后重试一次
+                if not reused or attempt:
+                    raise
+                logging.warning(f"设备 {host} 复用的会话在巡检中断开: {str(e)}，重新连接后重试")
 
         logging.info(f"设备 {host} 巡检完成，报告已保存到 {report_filename}")
         return True
@@ -385,12 +908,11 @@ def execute_inspection(device, result_dir):
             f.write(f"巡检过程中发生错误: {str(e)}")
         logging.error(f"设备 {host} 巡检失败: {str(e)}")
         return False
-    finally:
-        if conn:
-            if isinstance(conn, telnetlib.Telnet):
-                conn.close()
-            else:
-                conn.disconnect()
+
+# 受会话并发限制的巡检任务
+def limited_inspection(device, result_dir, timestamp=None):
+    with session_slot(device):
+        return execute_inspection(device, result_dir, timestamp)
 
 # 开始巡检
 def start_inspection(input_file, result_dir):
@@ -401,8 +923,12 @@ def start_inspection(input_file, result_dir):
         messagebox.showerror("错误", "未找到有效的设备信息，请检查输入文件。")
         return
 
-    with ThreadPoolExecutor() as executor:
-        futures = [executor.submit(execute_inspection, device, result_dir) for device in devices]
+    # 同一批次的报告文件名共用一个时间标记，报告中的巡检时间仍按设备实际巡检时刻记录
+    timestamp = time.strftime("%Y%m%d-%H%M%S")
+    max_workers = max(1, min(len(devices), THREAD_POOL_CONFIG["max_workers"]))
+    logging.info(f"巡检线程池大小: {max_workers}（设备数: {len(devices)}，上限: {THREAD_POOL_CONFIG['max_workers']}）")
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [executor.submit(limited_inspection, device, result_dir, timestamp) for device in devices]
         for future in as_completed(futures):
             future.result()
 
@@ -437,4 +963,5 @@ if __name__ == "__main__":
     start_button.grid(row=1, column=1, padx=5, pady=20)
 
     root.mainloop()
+    CONNECTION_POOL.close_all()
     